@@ -10,16 +10,16 @@ Single-file Streamlit app — PIXID XML Corrector (GitHub auto-sync) ⛭
 - Encodage d'origine du XML préservé.
 """
 
-import io
 import re
 import csv
-import json
-import time
+import orjson
+import functools
+import hashlib
 import requests
 import pandas as pd
 import streamlit as st
 from io import BytesIO
-from urllib.parse import urlparse
+from typing import BinaryIO
 from lxml import etree
 
 # =========================
@@ -80,7 +80,7 @@ def load_commandes(text: str, key_field: str = "numero_commande") -> dict:
     """
     stripped = (text or "").lstrip()
     if stripped.startswith("{") or stripped.startswith("["):
-        data = json.loads(text)
+        data = orjson.loads(text)
         
         # CAS SPÉCIAL : Format avec clé "commandes" (minuscule) contenant les données
         if isinstance(data, dict) and "commandes" in data:
@@ -118,6 +118,71 @@ def load_commandes(text: str, key_field: str = "numero_commande") -> dict:
         if key: out[key] = {k:(v.strip() if isinstance(v,str) else v) for k,v in row.items()}
     return out
 
+@st.cache_resource(ttl=CACHE_TTL_S, show_spinner=False)
+def load_commandes_shared(text: str) -> dict:
+    """
+    load_commandes partagé entre toutes les sessions (parsing fait une fois par contenu).
+    Le dict retourné est commun : ne pas le modifier.
+    """
+    return load_commandes(text)
+
+@st.cache_resource(ttl=CACHE_TTL_S, show_spinner=False)
+def commandes_dataframe(_commandes: dict, source_text: str) -> pd.DataFrame:
+    """
+    Convertit les commandes en DataFrame d'affichage (construction vectorisée côté pandas).
+    Partagé entre sessions et reruns : ne pas le modifier en place.
+    L'index est la clé normalisée (ORDERID).
+    """
+    if all(isinstance(data, dict) for data in _commandes.values()):
+        df = pd.DataFrame.from_dict(_commandes, orient="index")
+        if "numero_commande" in df.columns:
+            # Lignes sans numero_commande : clé reprise de l'index
+            df["numero_commande"] = df["numero_commande"].fillna(pd.Series(df.index, index=df.index))
+        else:
+            df.insert(0, "numero_commande", df.index)
+        return df
+    # Formats mélangés : construction ligne par ligne
+    commandes_list = []
+    for order_id, data in _commandes.items():
+        if isinstance(data, dict):
+            row = {"numero_commande": order_id}
+            row.update(data)
+        else:
+            # Si data est une string ou autre, on la met dans une colonne "data"
+            row = {"numero_commande": order_id, "data": str(data)}
+        commandes_list.append(row)
+    return pd.DataFrame(commandes_list, index=list(_commandes))
+
+@st.cache_data(ttl=CACHE_TTL_S, show_spinner=False)
+def search_haystack(_df: pd.DataFrame, source_text: str) -> pd.Series:
+    """
+    Concatène toutes les colonnes en une chaîne par ligne, calculée une seule fois.
+    La clé de cache est le texte source des commandes (le DataFrame n'est pas haché).
+    """
+    cols = _df.astype(str)
+    # na_rep : une valeur nulle ne doit pas rendre toute la ligne introuvable
+    return cols.iloc[:, 0].str.cat(cols.iloc[:, 1:], sep=" ", na_rep="")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def search_commandes(_df: pd.DataFrame, source_text: str, query: str) -> pd.DataFrame:
+    """
+    Sous-chaîne (insensible à la casse) sur la haystack précalculée.
+    Résultat mis en cache par requête, les frappes répétées ne relancent pas le filtre.
+    """
+    haystack = search_haystack(_df, source_text)
+    return _df[haystack.str.contains(query, case=False, regex=False, na=False)]
+
+def _df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    # Écriture directe en binaire : pas de str intermédiaire puis .encode()
+    buf = BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
+@st.cache_data(ttl=CACHE_TTL_S, show_spinner=False)
+def commandes_csv_bytes(_df: pd.DataFrame, source_text: str) -> bytes:
+    """CSV des commandes, mis en cache par texte source (le DataFrame n'est pas haché)."""
+    return _df_to_csv_bytes(_df)
+
 # =========================
 # Helpers XML (enricher 3 champs)
 # =========================
@@ -131,34 +196,46 @@ XP_STATUS_DESC = ".//*[local-name()='PositionCharacteristics']/*[local-name()='P
 
 CLASS_RE = re.compile(r"^[A-E]\d{1,2}$")
 
-def parse_tree(xml_bytes: bytes) -> etree._ElementTree:
-    parser = etree.XMLParser(remove_blank_text=True, recover=True, huge_tree=True)
-    return etree.parse(BytesIO(xml_bytes), parser)
+# Schéma fixe du récapitulatif par contrat (ordre des colonnes du CSV)
+RECAP_COLUMNS = [
+    "OrderId", "AssignmentId",
+    "PositionCoefficient", "PositionStatusCode", "PositionStatusDescription",
+    "matched", "note",
+]
 
-def to_bytes(tree: etree._ElementTree) -> bytes:
+def parse_tree(xml_source: bytes | BinaryIO) -> etree._ElementTree:
+    """
+    `xml_source` : bytes ou objet fichier. Un objet fichier (ex: UploadedFile Streamlit)
+    est lu directement par lxml, sans copie intermédiaire en `bytes`.
+    """
+    if isinstance(xml_source, (bytes, bytearray)):
+        xml_source = BytesIO(xml_source)
+    # Blancs d'origine conservés ; pas de table d'IDs (inutile ici)
+    parser = etree.XMLParser(recover=True, huge_tree=True, collect_ids=False)
+    return etree.parse(xml_source, parser)
+
+def to_bytes(tree: etree._ElementTree, pretty_print: bool = False) -> bytes:
     enc = tree.docinfo.encoding or "UTF-8"
-    return etree.tostring(tree, encoding=enc, pretty_print=True, xml_declaration=True)
+    if pretty_print:
+        # Ré-indentation à l'émission (les blancs d'origine ne sont pas supprimés au parsing)
+        etree.indent(tree)
+    return etree.tostring(tree, encoding=enc, pretty_print=pretty_print, xml_declaration=True)
+
+@functools.lru_cache(maxsize=None)
+def _xpath(xp: str) -> etree.XPath:
+    """XPath compilé une seule fois ; smart_strings=False évite les allocations de smart-strings."""
+    return etree.XPath(xp, smart_strings=False)
 
 def xget(ctx: etree._Element, xp: str) -> str:
     try:
-        n = ctx.xpath(xp)
+        n = _xpath(xp)(ctx)
     except Exception:
         return ""
     return (n[0].text or "").strip() if n and n[0].text is not None else ""
 
-def _find_default_ns(el: etree._Element):
-    cur = el
-    while cur is not None:
-        ns = cur.nsmap.get(None)
-        if ns: return ns
-        cur = cur.getparent()
-    return None
-
-def xupsert(ctx: etree._Element, ln_path: str, value: str) -> None:
-    """
-    Crée si absent (dans le bon namespace) puis pose la valeur.
-    ln_path doit utiliser local-name(), ex: XP_COEFF / XP_STATUS_CODE / XP_STATUS_DESC
-    """
+@functools.lru_cache(maxsize=None)
+def _ln_parts(ln_path: str) -> tuple[str, ...]:
+    """Segments local-name() d'un chemin, extraits une seule fois par chemin (les chemins sont des constantes)."""
     parts = []
     tmp = ln_path
     while True:
@@ -169,33 +246,64 @@ def xupsert(ctx: etree._Element, ln_path: str, value: str) -> None:
         if k == -1: break
         parts.append(tmp[j:k])
         tmp = tmp[k+1:]
+    return tuple(parts)
+
+def xupsert(ctx: etree._Element, ln_path: str, value: str) -> None:
+    """
+    Crée si absent (dans le bon namespace) puis pose la valeur.
+    ln_path doit utiliser local-name(), ex: XP_COEFF / XP_STATUS_CODE / XP_STATUS_DESC
+    """
+    parts = _ln_parts(ln_path)
     if not parts:
-        nodes = ctx.xpath(ln_path)
+        nodes = _xpath(ln_path)(ctx)
         if nodes:
             nodes[0].text = value
         return
     cur = ctx
     for name in parts:
-        found = cur.xpath(f"./*[local-name()='{name}']")
+        found = _xpath(f"./*[local-name()='{name}']")(cur)
         if found:
             cur = found[0]
         else:
-            ns = _find_default_ns(cur)
+            # nsmap inclut les déclarations héritées : namespace par défaut du parent
+            ns = cur.nsmap.get(None)
             tag = f"{{{ns}}}{name}" if ns else name
             cur = etree.SubElement(cur, tag)
     cur.text = value
 
-def process_all(xml_bytes: bytes, commandes: dict) -> tuple[bytes, list[dict], dict]:
+def set_texts(nodes: list, value: str) -> None:
+    """Pose `value` sur chaque nœud ; aucune écriture si le texte est déjà identique."""
+    if len(nodes) == 1:
+        if nodes[0].text != value: nodes[0].text = value
+        return
+    for n in nodes:
+        if n.text != value: n.text = value
+
+@functools.lru_cache(maxsize=256)
+def split_statut(statut_complet: str) -> tuple[str, str]:
+    """
+    "OP - Opérateur" -> ("OP", "Opérateur"), encodage corrigé.
+    Mémoïsé pour tout le process : peu de statuts distincts, calculés une seule fois.
+    """
+    code, desc = statut_complet.split(" - ", 1)
+    # Corriger les problèmes d'encodage courants
+    desc = desc.strip().replace("?", "é").replace("?", "è").replace("?", "à")
+    return code.strip(), desc
+
+def process_all(xml_source: bytes | BinaryIO, commandes: dict, pretty_print: bool = False) -> tuple[bytes, list[dict], dict]:
     """
     Retourne: (xml_corrige_bytes, recaps_par_contrat, log_global)
+    pretty_print=True ré-indente la sortie (plus lent, fichier plus gros).
     """
-    tree = parse_tree(xml_bytes)
-    contexts = tree.xpath(XP_CTX)
+    tree = parse_tree(xml_source)
+    contexts = _xpath(XP_CTX)(tree)
     recaps = []
     upd_coeff = upd_code = upd_desc = 0
     modified_ids = []
     unmatched_sample = []
 
+    # Boucle volontairement séquentielle : tous les contrats partagent le même document
+    # lxml, qui ne supporte pas les modifications concurrentes depuis plusieurs threads.
     for ctx in contexts:
         order  = xget(ctx, XP_ORDER)
         assign = xget(ctx, XP_ASSIGN)
@@ -203,9 +311,24 @@ def process_all(xml_bytes: bytes, commandes: dict) -> tuple[bytes, list[dict], d
         row    = commandes.get(key)
 
         before_c   = xget(ctx, XP_COEFF)
+        level      = xget(ctx, XP_LEVEL)
+
+        # Non apparié et pas de repli Level -> Coefficient : rien ne changera,
+        # récap direct sans écriture ni relecture des balises.
+        if not row and (before_c or not CLASS_RE.match(level or "")):
+            if len(unmatched_sample) < 10:
+                unmatched_sample.append(order)
+            recaps.append({
+                "OrderId": order, "AssignmentId": assign,
+                "PositionCoefficient": before_c,
+                "PositionStatusCode": xget(ctx, XP_STATUS_CODE),
+                "PositionStatusDescription": xget(ctx, XP_STATUS_DESC),
+                "matched": False, "note": ""
+            })
+            continue
+
         before_code= xget(ctx, XP_STATUS_CODE)
         before_desc= xget(ctx, XP_STATUS_DESC)
-        level      = xget(ctx, XP_LEVEL)
 
         # 1) PositionCoefficient
         if row and (row.get("classification_interimaire") or "").strip():
@@ -218,11 +341,7 @@ def process_all(xml_bytes: bytes, commandes: dict) -> tuple[bytes, list[dict], d
         
         # Extraire le code et la description du statut (format: "OP - Opérateur")
         if " - " in statut_complet:
-            code, desc = statut_complet.split(" - ", 1)
-            code = code.strip()
-            desc = desc.strip()
-            # Corriger les problèmes d'encodage courants
-            desc = desc.replace("?", "é").replace("?", "è").replace("?", "à")
+            code, desc = split_statut(statut_complet)
         else:
             code = statut_complet
             desc = (row.get("statut_description") or "").strip() if row else ""
@@ -230,17 +349,17 @@ def process_all(xml_bytes: bytes, commandes: dict) -> tuple[bytes, list[dict], d
         
         if code:
             # Code : MAJ tous les noeuds existants; sinon en créer un
-            nodes_code = ctx.xpath(XP_STATUS_CODE)
+            nodes_code = _xpath(XP_STATUS_CODE)(ctx)
             if nodes_code:
-                for n in nodes_code: n.text = code
+                set_texts(nodes_code, code)
             else:
                 xupsert(ctx, XP_STATUS_CODE, code)
             # Description (depuis commandes ou mapping)
             final_desc = desc or STATUS_LABEL_MAP.get(code, desc)
             if final_desc:
-                nodes_desc = ctx.xpath(XP_STATUS_DESC)
+                nodes_desc = _xpath(XP_STATUS_DESC)(ctx)
                 if nodes_desc:
-                    for n in nodes_desc: n.text = final_desc
+                    set_texts(nodes_desc, final_desc)
                 else:
                     xupsert(ctx, XP_STATUS_DESC, final_desc)
 
@@ -272,7 +391,7 @@ def process_all(xml_bytes: bytes, commandes: dict) -> tuple[bytes, list[dict], d
             "matched": bool(row), "note": note
         })
 
-    out_bytes = to_bytes(tree)
+    out_bytes = to_bytes(tree, pretty_print)
     log = {
         "contracts_detected": len(contexts),
         "coef_updates": upd_coeff,
@@ -286,14 +405,32 @@ def process_all(xml_bytes: bytes, commandes: dict) -> tuple[bytes, list[dict], d
 
     return out_bytes, recaps, log
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def process_all_cached(_xml_file: BinaryIO, xml_digest: str, _commandes: dict, source_text: str,
+                       pretty_print: bool = False) -> tuple[bytes, list[dict], dict, bytes]:
+    """
+    process_all mis en cache par (empreinte du XML, texte source des commandes) :
+    un rerun sur le même fichier ne relance pas la correction.
+    Retourne aussi le CSV récapitulatif, mis en cache avec le résultat.
+    """
+    _xml_file.seek(0)
+    fixed_bytes, recaps, log = process_all(_xml_file, _commandes, pretty_print)
+    recap_csv = _df_to_csv_bytes(pd.DataFrame.from_records(recaps, columns=RECAP_COLUMNS))
+    return fixed_bytes, recaps, log, recap_csv
+
+def xml_digest(xml_file) -> str:
+    """Empreinte du fichier déposé, calculée sur le buffer en place (getbuffer, sans copie)."""
+    return hashlib.blake2b(xml_file.getbuffer(), digest_size=16).hexdigest()
+
 # =========================
 # Charger commandes depuis GitHub (auto)
 # =========================
 commandes_dict = None
 cmd_error = None
+text = None
 try:
     text = fetch_commandes_text(GITHUB_OWNER, GITHUB_REPO, GITHUB_REF, GITHUB_PATH)
-    commandes_dict = load_commandes(text)
+    commandes_dict = load_commandes_shared(text)
     st.success(f"✅ {len(commandes_dict)} commandes chargées depuis GitHub (auto-sync).")
 except requests.exceptions.HTTPError as e:
     if e.response.status_code == 404:
@@ -313,6 +450,10 @@ except Exception as e:
 colA, colB = st.columns([1, 4])
 if colA.button("🔄 Recharger les commandes (GitHub)"):
     fetch_commandes_text.clear()
+    # Libère aussi les objets partagés construits sur l'ancien contenu
+    load_commandes_shared.clear()
+    commandes_dataframe.clear()
+    commandes_csv_bytes.clear()
     st.rerun()
 with colB:
     st.write(
@@ -323,36 +464,23 @@ with colB:
 if commandes_dict:
     st.subheader(f"📋 Commandes disponibles ({len(commandes_dict)})")
     
-    # Convertir en DataFrame pour affichage
-    commandes_list = []
-    for order_id, data in commandes_dict.items():
-        # Gérer les différents formats de données
-        if isinstance(data, dict):
-            row = {"numero_commande": order_id}
-            row.update(data)
-        else:
-            # Si data est une string ou autre, on la met dans une colonne "data"
-            row = {"numero_commande": order_id, "data": str(data)}
-        commandes_list.append(row)
-    
-    if commandes_list:
-        df_commandes = pd.DataFrame(commandes_list)
-        
+    # DataFrame d'aperçu construit une seule fois par contenu source (pas à chaque rerun)
+    df_commandes = commandes_dataframe(commandes_dict, text)
+
+    if not df_commandes.empty:
         # Afficher avec possibilité de recherche
         search = st.text_input("🔍 Rechercher une commande", "")
         if search:
-            mask = df_commandes.astype(str).apply(lambda x: x.str.contains(search, case=False, na=False)).any(axis=1)
-            df_filtered = df_commandes[mask]
+            df_filtered = search_commandes(df_commandes, text, search)
             st.write(f"**{len(df_filtered)}** commande(s) trouvée(s)")
-            st.dataframe(df_filtered, use_container_width=True, height=300)
+            st.dataframe(df_filtered, use_container_width=True, height=300, hide_index=True)
         else:
-            st.dataframe(df_commandes, use_container_width=True, height=300)
+            st.dataframe(df_commandes, use_container_width=True, height=300, hide_index=True)
         
         # Bouton pour télécharger les commandes en CSV
-        csv = df_commandes.to_csv(index=False).encode("utf-8")
         st.download_button(
             "⬇️ Télécharger les commandes (CSV)",
-            data=csv,
+            data=commandes_csv_bytes(df_commandes, text),
             file_name="commandes_chargees.csv",
             mime="text/csv",
         )
@@ -364,22 +492,35 @@ st.divider()
 # =========================
 # XML input & traitement
 # =========================
-xml_file = st.file_uploader("📄 Déposez votre XML (multi-contrats, gros volumes OK)", type=["xml"])
-go = st.button("🚀 Corriger le XML", type="primary", disabled=not xml_file or not commandes_dict)
+@st.fragment
+def correction_panel(commandes_dict: dict | None, source_text: str | None) -> None:
+    """
+    Dépôt du XML, correction et téléchargements, isolés dans un fragment :
+    les clics ici ne relancent que ce bloc (pas le chargement ni l'aperçu des commandes).
+    """
+    xml_file = st.file_uploader("📄 Déposez votre XML (multi-contrats, gros volumes OK)", type=["xml"])
+    pretty = st.checkbox("Formater le XML (indentation)", value=False)
+    go = st.button("🚀 Corriger le XML", type="primary", disabled=not xml_file or not commandes_dict)
 
-if go:
-    if not commandes_dict:
-        st.warning("Aucune commande disponible (la synchro GitHub a échoué).")
-        st.stop()
+    if not xml_file or not commandes_dict:
+        return
+    # Les téléchargements relancent le fragment : on garde les résultats affichés tant que
+    # le même fichier (et la même option de formatage) est déposé ; le cache évite le retraitement.
+    run_key = (xml_digest(xml_file), pretty)
+    if go:
+        st.session_state["correction_run"] = run_key
+    if st.session_state.get("correction_run") != run_key:
+        return
 
     st.info(f"🔄 Traitement en cours avec {len(commandes_dict)} commandes disponibles...")
-    
-    xml_bytes = xml_file.read()
+
     try:
-        fixed_bytes, recaps, log = process_all(xml_bytes, commandes_dict)
+        fixed_bytes, recaps, log, recap_csv = process_all_cached(
+            xml_file, run_key[0], commandes_dict, source_text, pretty
+        )
     except Exception as e:
         st.error(f"Erreur traitement: {e}")
-        st.stop()
+        return
 
     # Résumé
     n = log.get("contracts_detected", 0)
@@ -400,11 +541,11 @@ if go:
 
     # Récap
     if recaps:
-        df = pd.DataFrame(recaps)
+        df = pd.DataFrame.from_records(recaps, columns=RECAP_COLUMNS)
         st.dataframe(df, use_container_width=True)
         st.download_button(
             "⬇️ CSV récapitulatif",
-            data=df.to_csv(index=False).encode("utf-8"),
+            data=recap_csv,
             file_name="recap.csv",
             mime="text/csv",
         )
@@ -417,4 +558,6 @@ if go:
         mime="application/xml",
     )
 
+correction_panel(commandes_dict, text)
+
 st.caption("Synchro GitHub publique → commandes (auto). Déposez seulement le XML. Détection namespace-agnostique. Upsert si balise absente. Encodage préservé.")
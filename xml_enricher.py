@@ -17,8 +17,10 @@ Met à jour exactement 3 balises par contrat:
 
 from lxml import etree
 from io import BytesIO
-import re, json, csv
-from typing import Dict, Any, List, Tuple, Optional
+import re, csv
+import orjson
+import functools
+from typing import Dict, Any, List, Tuple, Union, BinaryIO
 
 # --------- XPaths (namespace-agnostiques) ---------
 XP_CTX    = "//*[local-name()='ReferenceInformation'][*[local-name()='OrderId']/*[local-name()='IdValue']]/.."
@@ -44,36 +46,37 @@ STATUS_LABEL_MAP = {
 }
 
 # --------- Parsing / Writing ---------
-def _parse(xml_bytes: bytes) -> etree._ElementTree:
-    parser = etree.XMLParser(remove_blank_text=True, recover=True, huge_tree=True)
-    return etree.parse(BytesIO(xml_bytes), parser)
+def _parse(xml_source: Union[bytes, BinaryIO]) -> etree._ElementTree:
+    # bytes ou objet fichier ; un objet fichier est lu directement par lxml (pas de copie)
+    if isinstance(xml_source, (bytes, bytearray)):
+        xml_source = BytesIO(xml_source)
+    # Blancs d'origine conservés ; pas de table d'IDs (inutile ici)
+    parser = etree.XMLParser(recover=True, huge_tree=True, collect_ids=False)
+    return etree.parse(xml_source, parser)
 
-def _tobytes(tree: etree._ElementTree) -> bytes:
+def _tobytes(tree: etree._ElementTree, pretty_print: bool = False) -> bytes:
     enc = tree.docinfo.encoding or "UTF-8"
-    return etree.tostring(tree, encoding=enc, pretty_print=True, xml_declaration=True)
+    if pretty_print:
+        # Ré-indentation à l'émission (les blancs d'origine ne sont pas supprimés au parsing)
+        etree.indent(tree)
+    return etree.tostring(tree, encoding=enc, pretty_print=pretty_print, xml_declaration=True)
 
 # --------- Helpers XPath / Upsert ---------
+@functools.lru_cache(maxsize=None)
+def _xpath(xp: str) -> etree.XPath:
+    """XPath compilé une seule fois ; smart_strings=False évite les allocations de smart-strings."""
+    return etree.XPath(xp, smart_strings=False)
+
 def _xget(ctx: etree._Element, xp: str) -> str:
     try:
-        n = ctx.xpath(xp)
+        n = _xpath(xp)(ctx)
     except Exception:
         return ""
     return (n[0].text or "").strip() if n and n[0].text is not None else ""
 
-def _find_default_ns(el: etree._Element) -> Optional[str]:
-    cur = el
-    while cur is not None:
-        ns = cur.nsmap.get(None)
-        if ns:
-            return ns
-        cur = cur.getparent()
-    return None
-
-def _xupsert(ctx: etree._Element, ln_path: str, value: str) -> None:
-    """
-    ln_path = XPath avec local-name(), ex: XP_COEFF ou XP_STATUS_DESC
-    Crée proprement la hiérarchie si manquante (dans le bon namespace), puis pose le texte.
-    """
+@functools.lru_cache(maxsize=None)
+def _ln_parts(ln_path: str) -> Tuple[str, ...]:
+    """Segments local-name() d'un chemin, extraits une seule fois par chemin (les chemins sont des constantes)."""
     parts: List[str] = []
     tmp = ln_path
     while True:
@@ -84,22 +87,39 @@ def _xupsert(ctx: etree._Element, ln_path: str, value: str) -> None:
         if k == -1: break
         parts.append(tmp[j:k])
         tmp = tmp[k+1:]
+    return tuple(parts)
+
+def _xupsert(ctx: etree._Element, ln_path: str, value: str) -> None:
+    """
+    ln_path = XPath avec local-name(), ex: XP_COEFF ou XP_STATUS_DESC
+    Crée proprement la hiérarchie si manquante (dans le bon namespace), puis pose le texte.
+    """
+    parts = _ln_parts(ln_path)
     if not parts:
-        nodes = ctx.xpath(ln_path)
+        nodes = _xpath(ln_path)(ctx)
         if nodes:
             nodes[0].text = value
         return
     cur = ctx
     for name in parts:
-        found = cur.xpath(f"./*[local-name()='{name}']")
+        found = _xpath(f"./*[local-name()='{name}']")(cur)
         if found:
             cur = found[0]
         else:
-            ns = _find_default_ns(cur)
+            # nsmap inclut les déclarations héritées : namespace par défaut du parent
+            ns = cur.nsmap.get(None)
             tag = f"{{{ns}}}{name}" if ns else name
             cur = etree.SubElement(cur, tag)
     cur.text = value
 
+def _set_texts(nodes: list, value: str) -> None:
+    """Pose `value` sur chaque nœud ; aucune écriture si le texte est déjà identique."""
+    if len(nodes) == 1:
+        if nodes[0].text != value: nodes[0].text = value
+        return
+    for n in nodes:
+        if n.text != value: n.text = value
+
 # --------- Commandes (chargement + normalisation) ---------
 def _norm_key(k: Any) -> str:
     if k is None: return ""
@@ -125,8 +145,8 @@ def load_commandes(path_or_buf, key_field: str = "numero_commande") -> Dict[str,
     if isinstance(path_or_buf, str):
         p = path_or_buf.lower()
         if p.endswith(".json"):
-            with open(path_or_buf, "r", encoding="utf-8") as f:
-                return dict_from_json_obj(json.load(f))
+            with open(path_or_buf, "rb") as f:
+                return dict_from_json_obj(orjson.loads(f.read()))
         elif p.endswith(".csv"):
             out = {}
             with open(path_or_buf, "r", encoding="utf-8", newline="") as f:
@@ -149,7 +169,7 @@ def load_commandes(path_or_buf, key_field: str = "numero_commande") -> Dict[str,
             text = text.decode("utf-8", errors="ignore")
         stripped = text.lstrip()
         if stripped.startswith("{") or stripped.startswith("["):
-            return dict_from_json_obj(json.loads(text))
+            return dict_from_json_obj(orjson.loads(text))
         else:
             out = {}
             reader = csv.DictReader(text.splitlines())
@@ -161,15 +181,17 @@ def load_commandes(path_or_buf, key_field: str = "numero_commande") -> Dict[str,
             return out
 
 # --------- Cœur : 3 champs uniquement ---------
-def process_all(xml_bytes: bytes,
+def process_all(xml_source: Union[bytes, BinaryIO],
                 commandes: Dict[str, Dict[str, Any]],
-                classification_regex: str = r"^[A-E]\\d{1,2}$"
+                classification_regex: str = r"^[A-E]\\d{1,2}$",
+                pretty_print: bool = False
                ) -> Tuple[bytes, List[Dict[str, Any]], Dict[str, Any]]:
     """
     Retourne: (xml_corrige_bytes, recaps_par_contrat, log_global)
+    pretty_print=True ré-indente la sortie (désactivé par défaut : plus rapide et plus compact).
     """
-    tree = _parse(xml_bytes)
-    contexts = tree.xpath(XP_CTX)
+    tree = _parse(xml_source)
+    contexts = _xpath(XP_CTX)(tree)
     recaps: List[Dict[str, Any]] = []
     upd_coeff = upd_code = upd_desc = 0
     modified_ids: List[str] = []
@@ -177,6 +199,8 @@ def process_all(xml_bytes: bytes,
 
     class_re = re.compile(classification_regex)
 
+    # Boucle volontairement séquentielle : tous les contrats partagent le même document
+    # lxml, qui ne supporte pas les modifications concurrentes depuis plusieurs threads.
     for ctx in contexts:
         order  = _xget(ctx, XP_ORDER)
         assign = _xget(ctx, XP_ASSIGN)
@@ -184,9 +208,24 @@ def process_all(xml_bytes: bytes,
         row    = commandes.get(key)
 
         before_c   = _xget(ctx, XP_COEFF)
+        level      = _xget(ctx, XP_LEVEL)
+
+        # Non apparié et pas de repli Level -> Coefficient : rien ne changera,
+        # récap direct sans écriture ni relecture des balises.
+        if not row and (before_c or not class_re.match(level or "")):
+            if len(unmatched_sample) < 10:
+                unmatched_sample.append(order)
+            recaps.append({
+                "OrderId": order, "AssignmentId": assign,
+                "PositionCoefficient": before_c,
+                "PositionStatusCode": _xget(ctx, XP_STATUS_CODE),
+                "PositionStatusDescription": _xget(ctx, XP_STATUS_DESC),
+                "matched": False, "note": ""
+            })
+            continue
+
         before_code= _xget(ctx, XP_STATUS_CODE)
         before_desc= _xget(ctx, XP_STATUS_DESC)
-        level      = _xget(ctx, XP_LEVEL)
 
         # 1) Coefficient
         if row and (row.get("classification_interimaire") or "").strip():
@@ -200,17 +239,17 @@ def process_all(xml_bytes: bytes,
         final_desc = ""
         if code:
             # mettre à jour tous les <Code> existants; sinon en créer un
-            nodes_code = ctx.xpath(XP_STATUS_CODE_ALL)
+            nodes_code = _xpath(XP_STATUS_CODE_ALL)(ctx)
             if nodes_code:
-                for n in nodes_code: n.text = code
+                _set_texts(nodes_code, code)
             else:
                 _xupsert(ctx, XP_STATUS_CODE, code)
             # description
             final_desc = desc or STATUS_LABEL_MAP.get(code, desc)
             if final_desc:
-                nodes_desc = ctx.xpath(XP_STATUS_DESC_ALL)
+                nodes_desc = _xpath(XP_STATUS_DESC_ALL)(ctx)
                 if nodes_desc:
-                    for n in nodes_desc: n.text = final_desc
+                    _set_texts(nodes_desc, final_desc)
                 else:
                     _xupsert(ctx, XP_STATUS_DESC, final_desc)
 
@@ -243,7 +282,7 @@ def process_all(xml_bytes: bytes,
             "matched": bool(row), "note": note
         })
 
-    out_bytes = _tobytes(tree)
+    out_bytes = _tobytes(tree, pretty_print)
     log = {
         "contracts_detected": len(contexts),
         "coef_updates": upd_coeff,